@@ -144,11 +144,11 @@ class Port(MetadataObject):
         elif not self.client.guid:
             raise MetadataException('Attribute `client` is empty')
         
-        for f in self.metadata.ports.select(host=self.host, port=self.port, client=self.client.guid):
+        for f in self.metadata.ports.select(host=self.host, port=self.port, client=self.client.guid, primary=True):
             if self!=f:
                 raise MetadataException('Host and port is not unique')
         if self.f_port:
-            for f in self.metadata.ports.select(f_port=self.f_port):
+            for f in self.metadata.ports.select(f_port=self.f_port, primary=True):
                 if self!=f:
                     raise MetadataException('Forwarding port is not unique')
         else:
@@ -162,7 +162,7 @@ class Port(MetadataObject):
         min_port = int(self.metadata.get_option('min_port') or 20000)
         
         try:
-            f = next(self.metadata.ports.select(order_by='f_port DESC', limit=1))
+            f = next(self.metadata.ports.select(order_by='f_port DESC', limit=1, primary=True))
             new_port = max(min_port, f.f_port+1)
         except StopIteration:
             new_port = min_port
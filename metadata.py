@@ -1,5 +1,10 @@
 import os
+import glob
 import sqlite3
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from urllib.request import pathname2url
+from time import monotonic
 from uuid import uuid4
 from json import dumps as json_dumps
 from json import loads as json_loads
@@ -38,7 +43,7 @@ class __Field:
     def to_db(self, val):
         return val        
     
-    def from_db(self, val, md=None):
+    def from_db(self, val, md=None, primary=False):
         return val
 
 
@@ -66,7 +71,7 @@ class FieldBool(__Field):
     def to_db(self, val):
         return 1 if val else 0 
         
-    def from_db(self, val, md=None):
+    def from_db(self, val, md=None, primary=False):
         return val==1
     
 
@@ -78,7 +83,7 @@ class FieldDict(__Field):
     def to_db(self, val):
         return json_dumps(val)         
     
-    def from_db(self, val, md=None):
+    def from_db(self, val, md=None, primary=False):
         return json_loads(val) if isinstance(val, str) else self.default
         
 
@@ -90,7 +95,7 @@ class FieldDateTime(__Field):
     def to_db(self, val):
         return val.strftime('%Y-%m-%d %H:%M:%S')        
     
-    def from_db(self, val, md=None):
+    def from_db(self, val, md=None, primary=False):
         return dateparser(val) if isinstance(val, str) else self.default 
         
 class FieldDate(FieldDateTime):
@@ -104,15 +109,20 @@ class FieldObject(__Field):
         self.type = "TEXT"
         self.__class = cls    
     
+    @property
+    def cls(self):
+        return self.__class
    
     def to_db(self, val):
         return val.guid   
     
     
-    def from_db(self, val, md):
+    def from_db(self, val, md, primary=False):
         tab = md.get_table(self.__class.__name__)
+        if tab is None:
+            raise MetadataException(f"Нет таблицы для класса `{self.__class.__name__}`")
         try:
-            res = tab.read(guid=val)
+            res = tab.read(guid=val, primary=primary)
         except MetadataException:
             res = self.__class()
         return res
@@ -144,8 +154,8 @@ class MetadataObject:
             self.metadata.changes.set(self)
         return self
         
-    def init_record(self, table, db, guid=None):
-        self.__record = MetadataRecord(table, db, guid or self.guid)
+    def init_record(self, table, db, guid=None, primary=False):
+        self.__record = MetadataRecord(table, db, guid or self.guid, primary)
     
     @property
     def table(self):
@@ -174,20 +184,21 @@ class MetadataObject:
         for key, field in self.fields.items():
             val = value.get(key, None)
             if not val is None:
-                setattr(self, key, field.from_db(val, self.metadata))
+                setattr(self, key, field.from_db(val, self.metadata, primary=True))
             
 
 class MetadataRecord:
-    def __init__(self, table, db, guid=None):
+    def __init__(self, table, db, guid=None, primary=False):
         self.__db = db
         self.table = table        
         self.guid = guid   
+        self.primary = primary
         
     
     def read(self, obj: MetadataObject):
         if not self.guid:
             raise MetadataException("Нет идентификатора записи ")
-        cursor = self.__db.connection.cursor()
+        cursor = self.__db.get_connection(self.primary).cursor()
         query = f"""SELECT * from `{self.table.name}` WHERE `guid`='{self.guid}'"""
         cursor.execute(query)        
         row = cursor.fetchone()        
@@ -198,7 +209,7 @@ class MetadataRecord:
             key = item[0]
             val = item[1]
             field_type = obj.fields.get(key, FieldStr())
-            setattr(obj, key, field_type.from_db(val, self.table.metadata))
+            setattr(obj, key, field_type.from_db(val, self.table.metadata, primary=self.primary))
      
     
     def write(self, obj: MetadataObject, new_guid=None):
@@ -237,7 +248,7 @@ class MetadataRecord:
         cursor.execute(query)
         #if not cursor.fetchall():
         #    raise MetadataException('Не удалось выполнить запись')        
-        self.__db.connection.commit()
+        self.__db.commit()
         obj.guid = data["guid"]
         cursor.close()
         
@@ -262,6 +273,11 @@ class MetadataTable:
     @property
     def metadata(self):
         return self.__md
+    
+    
+    @property
+    def cls(self):
+        return self.__class
         
 
     def __init_structure(self):
@@ -282,7 +298,7 @@ class MetadataTable:
             if not field[0] in table_fields:
                 query = f"ALTER TABLE `{self.name}` ADD COLUMN `{field[0]}` {field[1].type}"
                 cursor.execute(query)
-                self.__db.connection.commit()
+                self.__db.commit(schema=True)
         cursor.close()
     
     
@@ -297,7 +313,7 @@ class MetadataTable:
         cursor = self.__db.connection.cursor()
         query = f"CREATE TABLE `{self.name}` ({','.join(str_fields)})"
         cursor.execute(query)
-        self.__db.connection.commit()
+        self.__db.commit(schema=True)
         cursor.close()
     
     
@@ -307,9 +323,9 @@ class MetadataTable:
         return obj
     
     
-    def read(self, guid):
+    def read(self, guid, primary=False):
         obj = self.__class()
-        obj.init_record(self, self.__db, guid=guid)
+        obj.init_record(self, self.__db, guid=guid, primary=primary)
         obj.read()
         return obj
         
@@ -323,17 +339,19 @@ class MetadataTable:
         if limit:
             filter_and_order.pop('limit')
             limit = f"LIMIT {limit}"    
+        # primary=True - читать из основной базы, минуя снимок
+        primary = filter_and_order.pop("primary", False)
             
         ls = [f"`{item[0]}`='{item[1]}'" for item in filter_and_order.items()]
         if not ls:
             ls.append('1=1')
-        cursor = self.__db.connection.cursor()        
+        cursor = self.__db.get_connection(primary).cursor()        
         query = f"""SELECT `guid` from `{self.name}` WHERE {" AND ".join(ls)} {order_by} {limit}""" 
         cursor.execute(query)
         rows = cursor.fetchall()
         cursor.close()
         for row in rows:
-            yield self.read(row['guid'])
+            yield self.read(row['guid'], primary)
         
 
 class Database:
@@ -345,15 +363,111 @@ class Database:
         return d
         
         
-    def __init__(self, path):
+    def __init__(self, path, snapshot=False, snapshot_interval=1, mmap_size=0):
+        # snapshot_interval - минимальный возраст снимка в секундах перед обновлением.
+        # Каждое обновление копирует всю базу в память, при 0 копия делается при первом чтении после любой записи
+        if isinstance(snapshot_interval, bool) or not isinstance(snapshot_interval, (int, float)) or snapshot_interval < 0:
+            raise MetadataException('Attribute `snapshot_interval` must be a non-negative number')
         self.connection = None
+        self.snapshot = snapshot
+        self.snapshot_interval = snapshot_interval
+        self.__snapshot = None
+        self.__snapshot_time = None
+        self.__snapshot_version = None
+        self.__source = None
+        self.__changed = False
+        self.__lock = threading.Lock()
         full_path = os.path.join(path, 'nexum.db')
+        self.path = full_path
         try:
             self.connection = sqlite3.connect(full_path, check_same_thread=False)
             self.connection.row_factory = Database.dict_factory
+            if mmap_size:
+                self.connection.execute(f"PRAGMA mmap_size={int(mmap_size)}")
+            if snapshot:
+                # Отдельное соединение для копирования снимка и PRAGMA data_version,
+                # которая меняется после записи любым другим соединением, в том числе основным
+                self.__source = sqlite3.connect(full_path, check_same_thread=False)
         except sqlite3.Error as error:
             print(f"Ошибка при подключении к sqlite ({full_path}): {error}")
             self.connection = None
+    
+    
+    @property
+    def read_connection(self):
+        # В режиме снимка чтение идет из копии базы в памяти,
+        # копия обновляется после записи не чаще snapshot_interval секунд
+        if not self.snapshot or self.connection is None:
+            return self.connection
+        snapshot = self.__snapshot
+        if snapshot is None:
+            with self.__lock:
+                if self.__snapshot is None:
+                    self.__refresh()
+                return self.__snapshot
+        if self.snapshot_age >= self.snapshot_interval and self.__lock.acquire(blocking=False):
+            # Обновляет один поток, остальные в это время читают текущий снимок
+            try:
+                if self.__snapshot is not None and self.__is_stale():
+                    self.__refresh()
+                snapshot = self.__snapshot or snapshot
+            finally:
+                self.__lock.release()
+        return snapshot
+    
+    
+    def get_connection(self, primary=False):
+        return self.connection if primary else self.read_connection
+    
+    
+    @property
+    def snapshot_age(self):
+        if self.__snapshot_time is None:
+            return None
+        return monotonic() - self.__snapshot_time
+    
+    
+    @property
+    def is_stale(self):
+        if not self.snapshot:
+            return False
+        with self.__lock:
+            return self.__snapshot is not None and self.__is_stale()
+    
+    
+    def refresh_snapshot(self):
+        with self.__lock:
+            self.__refresh()
+    
+    
+    def __data_version(self):
+        return self.__source.execute("PRAGMA data_version").fetchone()[0]
+    
+    
+    def __is_stale(self):
+        return self.__changed or self.__data_version()!=self.__snapshot_version
+    
+    
+    def __refresh(self):
+        # Версия читается до копирования: запись во время копирования будет замечена при следующем чтении.
+        # Предыдущий снимок не закрывается: им еще могут пользоваться читатели, его закроет сборщик мусора
+        self.__changed = False
+        self.__snapshot_version = self.__data_version()
+        snapshot = sqlite3.connect(':memory:', check_same_thread=False)
+        snapshot.row_factory = Database.dict_factory
+        self.__source.backup(snapshot)
+        snapshot.execute("PRAGMA query_only=ON")
+        self.__snapshot = snapshot
+        self.__snapshot_time = monotonic()
+    
+    
+    def commit(self, schema=False):
+        self.connection.commit()
+        self.__changed = True
+        if schema:
+            # После изменения структуры старый снимок непригоден, следующее чтение создаст новый
+            with self.__lock:
+                self.__snapshot = None
 
 
 class Setting(MetadataObject):
@@ -392,9 +506,97 @@ class DataChanges:
             yield (value.get("obj"), value.get("send"))   
 
 
+def _guid_ranges(parts):
+    # Диапазоны guid по первым двум hex-символам, крайние диапазоны открыты, не более 256 диапазонов
+    parts = max(1, min(parts, 256))
+    bounds = [format(i * 256 // parts, '02x') for i in range(1, parts)]
+    return list(zip([None] + bounds, bounds + [None]))
+
+
+def _guid_where(alias, lo, hi):
+    # Записи с пустым guid попадают в первый диапазон
+    where, params = list(), list()
+    if lo is not None:
+        where.append(f"{alias}`guid`>=?")
+        params.append(lo)
+    if hi is not None:
+        where.append(f"({alias}`guid`<? OR {alias}`guid` IS NULL)" if lo is None else f"{alias}`guid`<?")
+        params.append(hi)
+    return where, params
+
+
+# Типы полей, которые выгрузка раскодирует в процессе-обработчике;
+# в процесс передается только имя типа, остальные поля (в том числе даты) выгружаются как хранятся
+_EXPORT_FIELDS = {cls.__name__: cls() for cls in (FieldBool, FieldDict)}
+
+
+def _field_tag(field):
+    for cls in type(field).__mro__:
+        if cls.__name__ in _EXPORT_FIELDS:
+            return cls.__name__
+    return None
+
+
+def _read_only_connection(db_path):
+    connection = sqlite3.connect(f"file:{pathname2url(db_path)}?mode=ro", uri=True)
+    connection.row_factory = Database.dict_factory
+    return connection
+
+
+def _scan_part(db_path, table, refs, lo, hi):
+    connection = _read_only_connection(db_path)
+    try:
+        cursor = connection.cursor()
+        result = list()
+        for field, ref_table, ref_class in refs:
+            where, params = _guid_where("t.", lo, hi)
+            where.append(f"t.`{field}` IS NOT NULL AND t.`{field}`!='' AND r.`guid` IS NULL")
+            query = f"""SELECT t.`guid` AS guid, t.`{field}` AS ref from `{table}` t 
+                        LEFT JOIN `{ref_table}` r ON r.`guid`=t.`{field}` WHERE {" AND ".join(where)}"""
+            cursor.execute(query, params)
+            for row in cursor.fetchall():
+                result.append({"table": table, "guid": row["guid"], "field": field, 
+                               "ref_table": ref_table, "ref_class": ref_class, "ref": row["ref"]})
+        cursor.close()
+    finally:
+        connection.close()
+    return result
+
+
+def _export_part(db_path, table, tags, lo, hi, out_path):
+    # Файл пишется под временным именем и переименовывается только после успешной выгрузки
+    tmp_path = out_path + '.tmp'
+    connection = _read_only_connection(db_path)
+    try:
+        cursor = connection.cursor()
+        where, params = _guid_where("", lo, hi)
+        if not where:
+            where.append('1=1')
+        query = f"""SELECT * from `{table}` WHERE {" AND ".join(where)} ORDER BY `guid`"""
+        cursor.execute(query, params)
+        count = 0
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for row in cursor:
+                for key, val in row.items():
+                    field_type = _EXPORT_FIELDS.get(tags.get(key))
+                    if field_type and not val is None:
+                        row[key] = field_type.from_db(val)
+                f.write(json_dumps(row, ensure_ascii=False) + "\n")
+                count += 1
+        cursor.close()
+        os.replace(tmp_path, out_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    finally:
+        connection.close()
+    return out_path, count
+
+
 class Metadata:    
-    def __init__(self, path: str):
-        self.db = Database(path)
+    def __init__(self, path: str, snapshot: bool=False, snapshot_interval: float=1, mmap_size: int=0):
+        self.db = Database(path, snapshot, snapshot_interval, mmap_size)
         self.__tables = list()
         self.add_table('_setting', Setting)
         self.__setting_cache = dict()
@@ -414,6 +616,62 @@ class Metadata:
                 return tab
         return None
     
+    
+    def __refs(self, tab):
+        # Ссылки на классы без таблицы возвращаются отдельно с ref_table=None
+        refs, unresolved = list(), list()
+        for key, field in tab.cls().fields.items():
+            if isinstance(field, FieldObject):
+                ref_tab = self.get_table(field.cls.__name__)
+                if ref_tab:
+                    refs.append((key, ref_tab.name, field.cls.__name__))
+                else:
+                    unresolved.append({"table": tab.name, "guid": None, "field": key, 
+                                       "ref_table": None, "ref_class": field.cls.__name__, "ref": None})
+        return refs, unresolved
+    
+    
+    def scan(self, workers=None, parts=None):
+        # Поиск ссылок FieldObject на несуществующие записи, 
+        # каждая таблица делится на диапазоны guid и проверяется в отдельном процессе.
+        # Поля-ссылки на классы без таблицы попадают в отчет с ref_table=None.
+        # При запуске процессов через spawn (Windows) вызывающий скрипт должен быть под if __name__ == '__main__'
+        parts = parts or workers or os.cpu_count() or 1
+        result = {name: list() for name in self.__tables}
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = list()
+            for name in self.__tables:
+                refs, result[name] = self.__refs(getattr(self, name))
+                if not refs:
+                    continue
+                for lo, hi in _guid_ranges(parts):
+                    futures.append((name, executor.submit(_scan_part, self.db.path, name, refs, lo, hi)))
+            for name, future in futures:
+                result[name].extend(future.result())
+        return result
+    
+    
+    def export(self, path, workers=None, parts=None):
+        # Выгрузка всех таблиц в NDJSON, файл на каждый диапазон guid: <таблица>.<номер>.ndjson,
+        # файлы предыдущей выгрузки таблицы удаляются. Как и для scan(), нужен if __name__ == '__main__'
+        parts = parts or workers or os.cpu_count() or 1
+        os.makedirs(path, exist_ok=True)
+        result = {name: list() for name in self.__tables}
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = list()
+            for name in self.__tables:
+                tags = { key: _field_tag(value) for key, value in getattr(self, name).cls().fields.items() }
+                tags['deleted'] = 'FieldBool'
+                for old_path in glob.glob(os.path.join(glob.escape(path), f"{glob.escape(name)}.[0-9][0-9][0-9].ndjson*")):
+                    os.remove(old_path)
+                for i, (lo, hi) in enumerate(_guid_ranges(parts)):
+                    out_path = os.path.join(path, f"{name}.{i:03}.ndjson")
+                    futures.append((name, executor.submit(_export_part, self.db.path, name, tags, lo, hi, out_path)))
+            for name, future in futures:
+                result[name].append(future.result())
+        return result
+    
+    
     def select_options(self, **filt):
         return self._setting.select(**filt)
     
@@ -423,7 +681,7 @@ class Metadata:
         if not value is None:
             return value
         try:
-            s = next(self._setting.select(name=key))
+            s = next(self._setting.select(name=key, primary=True))
         except StopIteration:
             return None
         if s.val_type=='bool':
@@ -439,7 +697,7 @@ class Metadata:
     def set_option(self, name, value, description=None, val_type=None):        
         self.__setting_cache[name] = value
         try:
-            s = next(self._setting.select(name=name))
+            s = next(self._setting.select(name=name, primary=True))
         except StopIteration:
             s = self._setting.add()
             s.name = name                    
@@ -454,7 +712,7 @@ class Metadata:
         
     def init_setting(self, data):
         keys = list()
-        for opt in self._setting.select():        
+        for opt in self._setting.select(primary=True):        
             if opt.name in data:
                 keys.append(opt.name)
         for key, value in data.items():
@@ -0,0 +1,216 @@
+import os
+import glob
+import json
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from metadata import *
+
+
+class Item(MetadataObject):
+    def __init__(self):
+        super().__init__()
+        self.fields = Fields(name=FieldStr(), count=FieldInt(), setting=FieldDict(), 
+                             day=FieldDate(), created=FieldDateTime())
+        self.set_default()
+
+
+class Link(MetadataObject):
+    def __init__(self):
+        super().__init__()
+        self.fields = Fields(name=FieldStr(), item=FieldObject(Item))
+        self.set_default()
+
+
+class ExtendedItem(MetadataObject):
+    def __init__(self):
+        super().__init__()
+        self.fields = Fields(name=FieldStr(), count=FieldInt(), setting=FieldDict(), 
+                             day=FieldDate(), created=FieldDateTime(), note=FieldStr())
+        self.set_default()
+
+
+class Unregistered(MetadataObject):
+    pass
+
+
+class Orphan(MetadataObject):
+    def __init__(self):
+        super().__init__()
+        self.fields = Fields(name=FieldStr(), owner=FieldObject(Unregistered))
+        self.set_default()
+
+
+class MetadataTestCase(unittest.TestCase):
+    options = dict()
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.md = Metadata(self.path, **self.options)
+        self.md.add_table('items', Item)
+        self.md.add_table('links', Link)
+
+    def tearDown(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def add_item(self, name, count=0):
+        item = self.md.items.add()
+        item.name = name
+        item.count = count
+        item.write(reg=False)
+        return item
+
+    def add_link(self, item):
+        link = self.md.links.add()
+        link.item = item
+        link.write(reg=False)
+        return link
+
+
+class SnapshotTest(MetadataTestCase):
+    options = dict(snapshot=True, snapshot_interval=60)
+
+    def test_read_after_write_is_stale_until_interval(self):
+        self.add_item('a')
+        self.assertEqual(len(list(self.md.items.select())), 1)
+        self.assertFalse(self.md.db.is_stale)
+        self.assertLess(self.md.db.snapshot_age, 60)
+
+        self.add_item('b')
+        self.assertTrue(self.md.db.is_stale)
+        self.assertEqual(len(list(self.md.items.select())), 1)
+        self.assertEqual(len(list(self.md.items.select(primary=True))), 2)
+
+        self.md.db.refresh_snapshot()
+        self.assertFalse(self.md.db.is_stale)
+        self.assertEqual(len(list(self.md.items.select())), 2)
+
+    def test_zero_interval_reads_own_writes(self):
+        md = Metadata(self.path, snapshot=True, snapshot_interval=0)
+        md.add_table('items', Item)
+        self.assertEqual(len(list(md.items.select())), 0)
+        md.items.add().write(reg=False)
+        self.assertEqual(len(list(md.items.select())), 1)
+
+    def test_external_write_is_detected(self):
+        md = Metadata(self.path, snapshot=True, snapshot_interval=0)
+        md.add_table('items', Item)
+        self.assertEqual(len(list(md.items.select())), 0)
+        connection = sqlite3.connect(md.db.path)
+        connection.execute("INSERT INTO `items` (`guid`, `name`) VALUES ('external', 'x')")
+        connection.commit()
+        connection.close()
+        self.assertTrue(md.db.is_stale)
+        self.assertEqual([item.guid for item in md.items.select()], ['external'])
+        self.assertFalse(md.db.is_stale)
+
+    def test_set_option_uses_primary(self):
+        self.md.set_option('a', 1)
+        self.md.set_option('a', 2)
+        self.assertEqual(len(list(self.md._setting.select(primary=True))), 1)
+        self.assertEqual(self.md.get_option('a'), 2)
+
+    def test_references_follow_parent_connection(self):
+        self.add_link(self.add_item('a'))
+        self.md.db.refresh_snapshot()
+        flags = list()
+        get_connection = self.md.db.get_connection
+        def spy(primary=False):
+            flags.append(primary)
+            return get_connection(primary)
+        self.md.db.get_connection = spy
+
+        links = list(self.md.links.select())
+        self.assertEqual(links[0].item.name, 'a')
+        self.assertEqual(flags, [False, False, False])
+
+        flags.clear()
+        self.assertEqual(self.md.links.read(links[0].guid, primary=True).item.name, 'a')
+        self.assertEqual(flags, [True, True])
+
+    def test_schema_change_drops_snapshot(self):
+        list(self.md.items.select())
+        self.md.add_table('others', Item)
+        self.assertEqual(list(self.md.others.select()), [])
+
+        self.add_item('a')
+        self.md.add_table('items', ExtendedItem)
+        item = next(self.md.items.select())
+        self.assertIsNone(item.note)
+
+    def test_snapshot_interval_is_validated(self):
+        for value in (None, -1, 'x'):
+            with self.assertRaises(MetadataException):
+                Metadata(self.path, snapshot=True, snapshot_interval=value)
+
+    def test_mmap_size(self):
+        md = Metadata(self.path, mmap_size=1 << 20)
+        self.assertEqual(md.db.connection.execute("PRAGMA mmap_size").fetchone()['mmap_size'], 1 << 20)
+
+
+class ScanExportTest(MetadataTestCase):
+    def setUp(self):
+        super().setUp()
+        self.out = os.path.join(self.path, 'out')
+        for n in range(20):
+            self.add_link(self.add_item(f'item {n}', n))
+        self.missing = self.add_item('missing')
+        self.dangling = self.add_link(self.missing)
+        self.execute(f"DELETE FROM `items` WHERE `guid`='{self.missing.guid}'")
+        self.execute("INSERT INTO `items` (`guid`, `name`) VALUES (NULL, 'no guid')")
+
+    def execute(self, query):
+        self.md.db.connection.execute(query)
+        self.md.db.connection.commit()
+
+    def read_shards(self, shards):
+        rows = list()
+        for shard, _ in shards:
+            with open(shard, encoding='utf-8') as f:
+                rows.extend(json.loads(line) for line in f)
+        return rows
+
+    def test_scan_reports_dangling_reference(self):
+        for parts in (1, 4):
+            result = self.md.scan(workers=2, parts=parts)
+            self.assertEqual(result['items'], [])
+            self.assertEqual(result['links'], [{"table": "links", "guid": self.dangling.guid, "field": "item", 
+                                                "ref_table": "items", "ref_class": "Item", "ref": self.missing.guid}])
+
+    def test_scan_reports_unregistered_reference_class(self):
+        self.md.add_table('orphans', Orphan)
+        result = self.md.scan(workers=2, parts=2)
+        self.assertEqual(result['orphans'], [{"table": "orphans", "guid": None, "field": "owner", 
+                                              "ref_table": None, "ref_class": "Unregistered", "ref": None}])
+
+    def test_export_shards_add_up_to_table(self):
+        for parts in (1, 4, 300):
+            result = self.md.export(self.out, workers=2, parts=parts)
+            for name, shards in result.items():
+                count = self.md.db.connection.execute(f"SELECT COUNT(*) AS n FROM `{name}`").fetchone()['n']
+                self.assertEqual(sum(n for _, n in shards), count)
+                self.assertLessEqual(len(shards), 256)
+            self.assertIn(None, [row['guid'] for row in self.read_shards(result['items'])])
+
+    def test_export_keeps_stored_values(self):
+        rows = {row['name']: row for row in self.read_shards(self.md.export(self.out, workers=2, parts=2)['items'])}
+        self.assertEqual({k: rows['item 3'][k] for k in ('count', 'setting', 'deleted', 'day', 'created')},
+                         {'count': 3, 'setting': {}, 'deleted': False, 'day': '1970-01-01', 'created': '1970-01-01 00:00:00'})
+        self.assertEqual({k: rows['no guid'][k] for k in ('setting', 'deleted', 'day', 'created')},
+                         {'setting': None, 'deleted': None, 'day': None, 'created': None})
+
+    def test_export_removes_previous_shards(self):
+        self.md.export(self.out, workers=2, parts=8)
+        self.md.export(self.out, workers=2, parts=2)
+        self.assertEqual(len(glob.glob(os.path.join(self.out, 'items.*'))), 2)
+
+    def test_failed_export_leaves_no_partial_shard(self):
+        self.execute("UPDATE `items` SET `setting`='not json'")
+        with self.assertRaises(ValueError):
+            self.md.export(self.out, workers=2, parts=1)
+        self.assertEqual(glob.glob(os.path.join(self.out, 'items.*')), [])
+
+
+if __name__ == '__main__':
+    unittest.main()